@@ -3,109 +3,358 @@ Static Site Generator Builder.
 Processes HTML pages with Jinja2 templates and copies data files to the build directory.
 """
 
+import os
+import sys
+import json
 import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, TemplateNotFound
+
+# NOTE: below this many pages, spinning up worker processes costs more than it saves
+PARALLEL_MIN_PAGES = 16
+
+_worker_env = None
+
+def create_jinja_env(templates_dir, pages_dir, cache_dir):
+    return Environment(
+        loader=FileSystemLoader([str(templates_dir), str(pages_dir)]),
+        bytecode_cache=FileSystemBytecodeCache(str(cache_dir)),
+        autoescape=True,
+        trim_blocks=True,
+        lstrip_blocks=True
+    )
+
+def fast_copy(src, dst):
+    """Copies a file's contents and metadata, keeping the bytes in kernel space where possible."""
+    complete = False
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while True:
+                    count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30)
+                    if not count:
+                        break
+                    copied += count
+            # NOTE: some filesystems return 0 without copying anything, so only trust a copy that moved every byte
+            complete = copied > 0 and copied == size
+        except OSError:
+            # NOTE: some filesystems and kernels don't support it
+            pass
+    if not complete:
+        # NOTE: shutil falls back to sendfile or read/write
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+def page_output_path(build_dir, page_name):
+    # NOTE: index page goes to build root
+    if page_name.lower() == 'index':
+        return build_dir / "index.html"
+    return build_dir / page_name / "index.html"
+
+def render_page(jinja_env, page_path, build_dir):
+    """Renders a single page into the build directory, returns (success, status message)."""
+    page_name = page_path.stem
+
+    try:
+        template = jinja_env.get_template(page_path.name)
+
+        # NOTE: the builder creates the output folder before handing the page over
+        output_path = page_output_path(build_dir, page_name)
+        # NOTE: stream the render into a temporary file instead of building the whole page in memory,
+        # it only replaces the live page once rendering finished so errors never leave half a page behind
+        temp_path = output_path.with_name(f".{output_path.name}.tmp")
+        try:
+            with open(temp_path, 'wb') as f:
+                template.stream().dump(f, encoding='utf-8')
+            os.replace(temp_path, output_path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+        return True, f"Built page: {page_name} -> {output_path.relative_to(build_dir)}"
+    except TemplateNotFound as e:
+        return False, f"Error processing {page_path.name}: Template not found - {e}"
+    except Exception as e:
+        return False, f"Error processing {page_path.name}: {e}"
+
+def _init_worker(templates_dir, pages_dir, cache_dir):
+    # NOTE: each worker process gets its own environment, the bytecode cache is shared on disk
+    global _worker_env
+    _worker_env = create_jinja_env(templates_dir, pages_dir, cache_dir)
+
+def _render_page_worker(page_path, build_dir):
+    return render_page(_worker_env, page_path, build_dir)
 
 class StaticSiteBuilder:
-    def __init__(self, root_dir="."):
+    def __init__(self, root_dir=".", verbose=True, parallel=True):
         self.root_dir = Path(root_dir)
+        self.verbose = verbose
+        # NOTE: long-lived callers like the dev server turn this off to keep reusing self.jinja_env
+        self.parallel = parallel
         self.data_dir = self.root_dir / "data"
         self.pages_dir = self.root_dir / "pages"
         self.templates_dir = self.root_dir / "templates"
         self.build_dir = self.root_dir / "build"
+        self.cache_dir = self.root_dir / ".jinja_cache"
+        self.manifest_path = self.root_dir / ".build_manifest.json"
+        # NOTE: maps source paths to the mtimes they were last built from and the output they produced
+        self.manifest = {}
+        # NOTE: messages are collected and written once per build instead of printed one by one
+        self._log = []
+        # NOTE: directories already created during this build, to skip redundant mkdir calls
+        self._known_dirs = set()
         
-        self.jinja_env = Environment(
-            loader=FileSystemLoader([str(self.templates_dir), str(self.pages_dir)]),
-            autoescape=True,
-            trim_blocks=True,
-            lstrip_blocks=True
-        )
-    
-    def clean_build_dir(self):
-        if self.build_dir.exists():
-            # NOTE: remove contents instead of the entire directory to avoid breaking the server
-            for item in self.build_dir.iterdir():
-                if item.is_dir():
-                    shutil.rmtree(item)
+        # NOTE: compiled templates are cached on disk between runs, and in memory by the
+        # environment itself, so keep a builder around to avoid reparsing on every rebuild
+        self.cache_dir.mkdir(exist_ok=True)
+        self.jinja_env = create_jinja_env(self.templates_dir, self.pages_dir, self.cache_dir)
+    
+    def log(self, message, verbose=False):
+        if verbose and not self.verbose:
+            return
+        self._log.append(message)
+    
+    def flush_log(self):
+        if self._log:
+            sys.stdout.write("\n".join(self._log) + "\n")
+            self._log.clear()
+    
+    def _ensure_dir(self, path):
+        if path not in self._known_dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self._known_dirs.add(path)
+    
+    def sync_build_dir(self, expected_files):
+        """Removes files from the build directory that no build step produced, leaving current ones in place."""
+        # NOTE: the directory itself is kept to avoid breaking the server
+        self.prune_dir(self.build_dir, expected_files)
+    
+    def prune_dir(self, directory, expected_files):
+        empty = True
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                path = Path(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    if self.prune_dir(path, expected_files):
+                        path.rmdir()
+                    else:
+                        empty = False
+                elif path in expected_files:
+                    empty = False
                 else:
-                    item.unlink()
-            print(f"Cleaned build directory: {self.build_dir}")
-        else:
-            self.build_dir.mkdir(exist_ok=True)
-            print(f"Created build directory: {self.build_dir}")
+                    path.unlink()
+                    self.log(f"Removed stale file: {path.relative_to(self.build_dir)}", verbose=True)
+        return empty
+    
+    def expected_files(self):
+        return {self.build_dir / entry["output"] for entry in self.manifest.values()}
+    
+    def load_manifest(self):
+        """Returns the manifest of the last build, or None when it is missing or can't be trusted."""
+        try:
+            manifest = json.loads(self.manifest_path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.log(f"Ignoring unreadable build manifest: {e}")
+            return None
+        
+        if not isinstance(manifest, dict) or not all(
+            isinstance(entry, dict) and "mtime" in entry and "output" in entry
+            for entry in manifest.values()
+        ):
+            self.log("Ignoring build manifest in an unknown format")
+            return None
+        return manifest
+    
+    def save_manifest(self):
+        self.manifest_path.write_bytes(json.dumps(self.manifest).encode('utf-8'))
+    
+    def manifest_key(self, path):
+        return Path(os.path.relpath(path, self.root_dir)).as_posix()
     
-    def copy_data_files(self):
+    def is_up_to_date(self, key, mtime, output_path):
+        entry = self.manifest.get(key)
+        return entry is not None and entry["mtime"] == mtime and output_path.exists()
+    
+    def record_output(self, key, mtime, output_path):
+        self.manifest[key] = {"mtime": mtime, "output": output_path.relative_to(self.build_dir).as_posix()}
+    
+    def has_section(self, source_dir):
+        prefix = self.manifest_key(source_dir) + "/"
+        return any(key.startswith(prefix) for key in self.manifest)
+    
+    def forget_missing(self, source_dir, seen_keys):
+        # NOTE: drops sources that were deleted so their outputs get removed from the build directory
+        prefix = self.manifest_key(source_dir) + "/"
+        for key in list(self.manifest):
+            if key.startswith(prefix) and key not in seen_keys:
+                del self.manifest[key]
+    
+    def changed_dirs(self, changed):
+        root = self.root_dir.resolve()
+        dirs = set()
+        for path in changed:
+            try:
+                dirs.add(Path(path).resolve().relative_to(root).parts[0])
+            except (ValueError, IndexError):
+                # NOTE: can't tell what this file affects, check everything
+                dirs.update((self.data_dir.name, self.pages_dir.name, self.templates_dir.name))
+        return dirs
+    
+    def copy_data_files(self, incremental=False):
         if not self.data_dir.exists():
-            print("No data directory found, skipping data files...")
+            self.log("No data directory found, skipping data files...")
+            self.forget_missing(self.data_dir, set())
             return
 
-        for item in self.data_dir.rglob("*"):
-            rel_path = item.relative_to(self.data_dir)
-            dest_path = self.build_dir / rel_path
+        # NOTE: scandir entries carry their file type, so walking doesn't stat every item
+        seen_keys = set()
+        pending_dirs = [self.data_dir]
+        while pending_dirs:
+            current_dir = pending_dirs.pop()
+            dest_dir = self.build_dir / current_dir.relative_to(self.data_dir)
+            self._ensure_dir(dest_dir)
 
-            if item.is_dir():
-                dest_path.mkdir(parents=True, exist_ok=True)
-                continue
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append(current_dir / entry.name)
+                    elif entry.is_file():
+                        key = self.manifest_key(entry.path)
+                        mtime = entry.stat().st_mtime
+                        dest_path = dest_dir / entry.name
+                        seen_keys.add(key)
+                        if incremental and self.is_up_to_date(key, mtime, dest_path):
+                            continue
 
-            if item.is_file():
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(item, dest_path)
-                print(f"Copied data file: {rel_path}")
+                        rel_path = os.path.relpath(entry.path, self.data_dir)
+                        fast_copy(entry.path, dest_path)
+                        self.record_output(key, mtime, dest_path)
+                        self.log(f"Copied data file: {rel_path}", verbose=True)
+        
+        self.forget_missing(self.data_dir, seen_keys)
     
     def process_page(self, page_path):
-        page_name = page_path.stem
-        
-        try:
-            template = self.jinja_env.get_template(page_path.name)
-            final_content = template.render()
-            
-            # NOTE: index page goes to build root
-            if page_name.lower() == 'index':
-                output_path = self.build_dir / "index.html"
-            else:
-                page_folder = self.build_dir / page_name
-                page_folder.mkdir(exist_ok=True)
-                output_path = page_folder / "index.html"
-            
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(final_content)
-            
-            print(f"Built page: {page_name} -> {output_path.relative_to(self.build_dir)}")
-        except TemplateNotFound as e:
-            print(f"Error processing {page_path.name}: Template not found - {e}")
-        except Exception as e:
-            print(f"Error processing {page_path.name}: {e}")
+        success, message = render_page(self.jinja_env, page_path, self.build_dir)
+        self.log(message, verbose=success)
+        return success
+    
+    def template_signature(self):
+        # NOTE: names are included so adding, removing or renaming a template changes it too
+        if not self.templates_dir.exists():
+            return []
+        with os.scandir(self.templates_dir) as entries:
+            return sorted([entry.name, entry.stat().st_mtime] for entry in entries if entry.is_file())
+    
+    def list_pages(self):
+        with os.scandir(self.pages_dir) as entries:
+            return [Path(entry.path) for entry in entries if entry.name.endswith(".html") and entry.is_file()]
     
-    def build_pages(self):
+    def build_pages(self, incremental=False):
         if not self.pages_dir.exists():
-            print("No pages directory found, skipping pages...")
+            self.log("No pages directory found, skipping pages...")
+            self.forget_missing(self.pages_dir, set())
             return
         
-        html_files = list(self.pages_dir.glob("*.html"))
+        html_files = self.list_pages()
+        self.forget_missing(self.pages_dir, {self.manifest_key(page_path) for page_path in html_files})
         if not html_files:
-            print("No HTML files found in pages directory...")
+            self.log("No HTML files found in pages directory...")
             return
         
+        # NOTE: pages don't track which template they extend, so any template change rebuilds all of them
+        template_signature = self.template_signature()
+        pending = []
         for page_path in html_files:
-            self.process_page(page_path)
+            key = self.manifest_key(page_path)
+            signature = [page_path.stat().st_mtime, template_signature]
+            output_path = page_output_path(self.build_dir, page_path.stem)
+            if incremental and self.is_up_to_date(key, signature, output_path):
+                continue
+            self._ensure_dir(output_path.parent)
+            pending.append((page_path, key, signature, output_path))
+        
+        if not pending:
+            self.log("All pages are up to date...")
+            return
+        
+        if not self.parallel or len(pending) < PARALLEL_MIN_PAGES or (os.cpu_count() or 1) < 2:
+            for page_path, key, signature, output_path in pending:
+                if self.process_page(page_path):
+                    self.record_output(key, signature, output_path)
+                else:
+                    # NOTE: forget the page so its outdated output gets pruned
+                    self.manifest.pop(key, None)
+            return
+
+        page_paths = [page_path for page_path, _, _, _ in pending]
+        # NOTE: spawn instead of fork, forking a process with other threads running can deadlock
+        with ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.templates_dir, self.pages_dir, self.cache_dir)
+        ) as executor:
+            results = executor.map(_render_page_worker, page_paths, repeat(self.build_dir))
+            for (page_path, key, signature, output_path), (success, message) in zip(pending, results):
+                self.log(message, verbose=success)
+                if success:
+                    self.record_output(key, signature, output_path)
+                else:
+                    self.manifest.pop(key, None)
     
-    def build(self):
+    def build(self, changed=None):
+        """Builds the whole site, or only what changed since the last build when given the changed paths."""
         print("Starting static site build...")
+        incremental = changed is not None
         
         try:
-            self.clean_build_dir()
-            self.copy_data_files()
-            self.build_pages()
+            scan_data = scan_pages = True
+            if incremental:
+                manifest = self.load_manifest()
+                dirs = self.changed_dirs(changed)
+                scan_data = self.data_dir.name in dirs
+                scan_pages = bool({self.pages_dir.name, self.templates_dir.name} & dirs)
+                
+                # NOTE: outputs of skipped directories are only kept if the manifest knows about them,
+                # so without a trusted record of them fall back to a full build instead of pruning them
+                self.manifest = manifest or {}
+                trusted = manifest is not None
+                if not scan_data and self.data_dir.exists():
+                    trusted = trusted and self.has_section(self.data_dir)
+                if not scan_pages and self.pages_dir.exists():
+                    trusted = trusted and self.has_section(self.pages_dir)
+                if not trusted:
+                    self.log("No usable build manifest, doing a full build...")
+                    incremental = False
+                    scan_data = scan_pages = True
+            if not incremental:
+                self.manifest = {}
+            self._known_dirs.clear()
+            self._ensure_dir(self.build_dir)
+            
+            if scan_data:
+                self.copy_data_files(incremental)
+            if scan_pages:
+                self.build_pages(incremental)
+            self.sync_build_dir(self.expected_files())
+            self.save_manifest()
             
-            print("Build completed successfully!")
+            self.log("Build completed successfully!")
             return True
             
         except Exception as e:
-            print(f"Build failed: {e}")
+            self.log(f"Build failed: {e}")
             return False
+        finally:
+            self.flush_log()
 
 if __name__ == "__main__":
-    builder = StaticSiteBuilder()
+    builder = StaticSiteBuilder(verbose=sys.stdout.isatty())
     success = builder.build()
-    exit(0 if success else 1)
\ No newline at end of file
+    sys.exit(0 if success else 1)
\ No newline at end of file
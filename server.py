@@ -6,18 +6,24 @@ Needs watchdog packaged, install with 'pip install watchdog'.
 
 import os
 import sys
-import time
 import threading
+import urllib.parse
 from pathlib import Path
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from builder import StaticSiteBuilder
 
 class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    # NOTE: HTTP/1.1 keeps connections alive so browsers can reuse them for assets
+    protocol_version = 'HTTP/1.1'
+    etag = None
+    response_code = None
+    
     def log_message(self, format, *args):
         if args and len(args) > 1:
             status_code = args[1]
-            if status_code.startswith('2'):
+            if status_code.startswith('2') or status_code == '304':
                 return
         print(f"[{self.address_string()}] {format % args}")
     
@@ -26,25 +32,72 @@ class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
             super().do_GET()
         except (FileNotFoundError, OSError, PermissionError):
             print("Build in progress, serving rebuild page...")
-            self.send_response(503)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.send_header('Refresh', '2')
-            self.end_headers()
             rebuild_html = '''<!DOCTYPE html>
 <html><head><title>Site Rebuilding</title></head>
 <body style="font-family: 'JetBrains Mono', monospace; text-align: center; padding: 50px; background: #000; color: #f5f5dc;">
     <h2>Site Rebuilding...</h2>
     <p>The site is being rebuilt. This page will refresh automatically.</p>
     <script>setTimeout(() => location.reload(), 2000);</script>
-</body></html>'''
-            self.wfile.write(rebuild_html.encode('utf-8'))
+</body></html>'''.encode('utf-8')
+            self.send_response(503)
+            self.send_header('Content-type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(rebuild_html)))
+            self.send_header('Refresh', '2')
+            self.end_headers()
+            self.wfile.write(rebuild_html)
+    
+    def resolve_file(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # NOTE: directories without a trailing slash get redirected by the base handler
+            if not urllib.parse.urlsplit(self.path).path.endswith('/'):
+                return None
+            path = os.path.join(path, 'index.html')
+        return path if os.path.isfile(path) else None
+    
+    def send_head(self):
+        # NOTE: tag files with mtime and size so the browser revalidates with If-None-Match and gets a 304
+        self.etag = None
+        path = self.resolve_file()
+        if path is not None:
+            stat = os.stat(path)
+            self.etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+            if_none_match = self.headers.get('If-None-Match', '')
+            if self.etag in (tag.strip() for tag in if_none_match.split(',')):
+                self.send_response(304)
+                self.end_headers()
+                return None
+        return super().send_head()
+    
+    def send_response(self, code, message=None):
+        self.response_code = code
+        super().send_response(code, message)
+    
+    def end_headers(self):
+        # NOTE: the handler serves every request on a keep-alive connection, so the etag is only
+        # for the file response it was computed for and is dropped once headers go out
+        if self.etag and self.response_code in (200, 304):
+            self.send_header('ETag', self.etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.etag = None
+        super().end_headers()
+    
+    def copyfile(self, source, outputfile):
+        # NOTE: sendfile hands regular files to the kernel instead of copying them through python
+        if outputfile is self.wfile:
+            self.connection.sendfile(source)
+        else:
+            super().copyfile(source, outputfile)
 
 
 class FileChangeHandler(FileSystemEventHandler):
     def __init__(self, server_instance):
         self.server = server_instance
-        self.last_rebuild = 0
         self.debounce_seconds = 1
+        # NOTE: events are collected until things go quiet for debounce_seconds, then rebuilt in one go
+        self._pending = set()
+        self._timer = None
+        self._lock = threading.Lock()
     
     def should_rebuild(self, event_path):
         path = Path(event_path)
@@ -55,10 +108,6 @@ class FileChangeHandler(FileSystemEventHandler):
         relevant_extensions = {'.html', '.css', '.js', '.py'}
         if path.suffix not in relevant_extensions:
             return False
-        
-        current_time = time.time()
-        if current_time - self.last_rebuild < self.debounce_seconds:
-            return False
             
         return True
     
@@ -74,14 +123,42 @@ class FileChangeHandler(FileSystemEventHandler):
         if not event.is_directory and self.should_rebuild(event.src_path):
             self.trigger_rebuild(event.src_path)
     
+    def on_moved(self, event):
+        # NOTE: editors that save through a temporary file show up as moves
+        if event.is_directory:
+            return
+        for path in (event.src_path, event.dest_path):
+            if self.should_rebuild(path):
+                self.trigger_rebuild(path)
+    
     def trigger_rebuild(self, changed_file):
-        self.last_rebuild = time.time()
-        print(f"File changed: {changed_file}")
-        print("Rebuilding site...")
+        with self._lock:
+            self._pending.add(changed_file)
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce_seconds, self.flush_rebuild)
+            self._timer.daemon = True
+            self._timer.start()
+    
+    def flush_rebuild(self):
+        with self._lock:
+            changed, self._pending = self._pending, set()
+            if self._timer is threading.current_thread():
+                self._timer = None
         
-        rebuild_thread = threading.Thread(target=self.server.rebuild_site)
-        rebuild_thread.daemon = True
-        rebuild_thread.start()
+        if not changed:
+            return
+        for changed_file in sorted(changed):
+            print(f"File changed: {changed_file}")
+        print("Rebuilding site...")
+        self.server.rebuild_site(changed)
+    
+    def cancel(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = None
+            self._pending.clear()
 
 
 class StaticSiteServer:
@@ -91,8 +168,14 @@ class StaticSiteServer:
         self.server = None
         self.enable_hot_reload = enable_hot_reload
         self.file_observer = None
+        self.event_handler = None
         self.project_root = Path.cwd()
         self.skip_initial_build = skip_initial_build
+        
+        # NOTE: one builder for the whole session so its jinja environment keeps compiled templates,
+        # rebuilds are serialized since they share it and render in-process rather than in a worker pool
+        self.builder = StaticSiteBuilder(self.project_root, verbose=False, parallel=False)
+        self.rebuild_lock = threading.Lock()
     
     def check_build_dir(self):
         if not self.build_dir.exists():
@@ -111,19 +194,16 @@ class StaticSiteServer:
         
         return True
     
-    def rebuild_site(self):
+    def rebuild_site(self, changed=None):
         try:
-            from builder import StaticSiteBuilder
-            builder = StaticSiteBuilder(self.project_root)
-            success = builder.build()
+            with self.rebuild_lock:
+                success = self.builder.build(changed)
             
             if success:
                 print("Site rebuilt successfully!")
             else:
                 print("Site rebuild failed!")
                 
-        except ImportError:
-            print("Could not import builder.py")
         except Exception as e:
             print(f"Error during rebuild: {e}")
     
@@ -132,14 +212,14 @@ class StaticSiteServer:
             return
             
         try:
-            event_handler = FileChangeHandler(self)
+            self.event_handler = FileChangeHandler(self)
             self.file_observer = Observer()
             
             watch_dirs = ['pages', 'templates', 'data']
             for dir_name in watch_dirs:
                 watch_path = self.project_root / dir_name
                 if watch_path.exists():
-                    self.file_observer.schedule(event_handler, str(watch_path), recursive=True)
+                    self.file_observer.schedule(self.event_handler, str(watch_path), recursive=True)
                     print(f"Watching {dir_name}/ for changes...")
             
             self.file_observer.start()
@@ -155,6 +235,8 @@ class StaticSiteServer:
             self.file_observer.stop()
             self.file_observer.join()
             print("File watching stopped")
+        if self.event_handler:
+            self.event_handler.cancel()
     
     def start_server(self):
         if not self.skip_initial_build:
@@ -172,7 +254,7 @@ class StaticSiteServer:
         os.chdir(self.build_dir)
         
         try:
-            self.server = HTTPServer(('localhost', self.port), QuietHTTPRequestHandler)
+            self.server = ThreadingHTTPServer(('localhost', self.port), QuietHTTPRequestHandler)
             server_url = f"http://localhost:{self.port}"
             
             print(f"Starting development server...")